@@ -1,14 +1,35 @@
 import os
+import uuid
+import socket
+import signal
 import asyncio
+import argparse
+from typing import Optional
+from datetime import timedelta
 import requests
-from sqlalchemy import select, desc
-from database import async_session
+from sqlalchemy import select, update, desc, func, or_, DateTime
+from sqlalchemy.dialects.postgresql import insert # リース行の一括作成(UPSERT)用
+from database import async_session, create_tables
 import models
 import scraper
 
 # 環境変数からDiscord Webhook URLを取得
 DISCORD_WEBHOOK_URL = os.getenv("DISCORD_WEBHOOK_URL")
 
+# --- 複数ワーカーで分担するための設定 ---
+# 1回のリース取得で確保する商品数
+BATCH_SIZE = int(os.getenv("BATCH_UPDATE_BATCH_SIZE", "10"))
+# リースの有効期限（秒）。ハートビートが途切れるとこの時間で他のワーカーに開放される
+LEASE_SECONDS = int(os.getenv("BATCH_UPDATE_LEASE_SECONDS", "300"))
+# --loop 時、同じ商品を再スクレイピングするまでの最短間隔（分）
+RECHECK_MINUTES = int(os.getenv("BATCH_UPDATE_RECHECK_MINUTES", "60"))
+# --loop 時、対象商品がなかった場合の待機時間（秒）
+IDLE_SECONDS = int(os.getenv("BATCH_UPDATE_IDLE_SECONDS", "60"))
+# サーバーに負荷をかけないための商品ごとの待機時間（秒）
+SCRAPE_INTERVAL_SECONDS = 5
+# Discord通知のタイムアウト（秒）。ハートビートを止めないよう別スレッドで送信する
+DISCORD_TIMEOUT_SECONDS = 10
+
 def send_discord_notification(item_name, old_price, new_price, item_url, image_url=None):
     """Discordに価格変動を画像付きで通知する"""
     if not DISCORD_WEBHOOK_URL:
@@ -40,74 +61,263 @@ def send_discord_notification(item_name, old_price, new_price, item_url, image_u
         })
     
     try:
-        response = requests.post(DISCORD_WEBHOOK_URL, json=payload)
+        response = requests.post(DISCORD_WEBHOOK_URL, json=payload, timeout=DISCORD_TIMEOUT_SECONDS)
         response.raise_for_status()
     except Exception as e:
         print(f"Failed to send Discord notification: {e}")
 
-async def update_all_prices():
+def utc_now():
+    """DBサーバーの現在時刻（UTC, タイムゾーンなし）。ホスト間の時計ずれを避けるためDB側の時刻を使う
+    now() はトランザクション開始時刻を返すため、実際の時刻を返す clock_timestamp() を使う"""
+    return func.timezone("UTC", func.clock_timestamp(), type_=DateTime)
+
+async def ensure_leases():
+    """まだリース行のない商品に行を追加する"""
+    async with async_session() as db:
+        stmt = insert(models.ItemLease).from_select(
+            ["item_id"], select(models.Item.id)
+        ).on_conflict_do_nothing(index_elements=["item_id"])
+        await db.execute(stmt)
+        await db.commit()
+
+async def claim_items(worker_id: str, due_before):
+    """期限切れ・未割り当ての対象商品を FOR UPDATE SKIP LOCKED で確保する"""
     async with async_session() as db:
-        # 1. DBから全商品を取得
-        stmt = select(models.Item)
+        stmt = (
+            select(models.ItemLease.item_id)
+            .where(
+                or_(
+                    models.ItemLease.lease_expires_at.is_(None),
+                    models.ItemLease.lease_expires_at < utc_now(),
+                ),
+                or_(
+                    models.ItemLease.last_checked_at.is_(None),
+                    models.ItemLease.last_checked_at < due_before,
+                ),
+            )
+            .order_by(models.ItemLease.last_checked_at.asc().nulls_first())
+            .limit(BATCH_SIZE)
+            .with_for_update(skip_locked=True)
+        )
         result = await db.execute(stmt)
-        items = result.scalars().all()
-        
-        print(f"Starting batch update for {len(items)} items...")
+        item_ids = result.scalars().all()
 
-        for item in items:
-            print(f"--- Scraping: {item.name} ---")
-            try:
-                # 2. 直前の価格履歴を取得（最新の1件）
-                hist_stmt = (
-                    select(models.PriceHistory)
-                    .where(models.PriceHistory.item_id == item.id)
-                    .order_by(desc(models.PriceHistory.created_at))
-                    .limit(1)
+        if not item_ids:
+            return []
+
+        # 行ロックはコミットで外れるが、以降はリース(owner + 有効期限)で排他する
+        await db.execute(
+            update(models.ItemLease)
+            .where(models.ItemLease.item_id.in_(item_ids))
+            .values(
+                owner=worker_id,
+                lease_expires_at=utc_now() + timedelta(seconds=LEASE_SECONDS),
+            )
+        )
+        await db.commit()
+        return list(item_ids)
+
+def finish_lease_stmt(worker_id: str, item_id: int):
+    """自分が保持しているリースを解放し、完了時刻を記録する UPDATE 文"""
+    return (
+        update(models.ItemLease)
+        .where(
+            models.ItemLease.item_id == item_id,
+            models.ItemLease.owner == worker_id,
+        )
+        .values(owner=None, lease_expires_at=None, last_checked_at=utc_now())
+    )
+
+async def release_leases(worker_id: str):
+    """自分が保持しているリースをすべて解放する（中断時用）"""
+    async with async_session() as db:
+        await db.execute(
+            update(models.ItemLease)
+            .where(models.ItemLease.owner == worker_id)
+            .values(owner=None, lease_expires_at=None)
+        )
+        await db.commit()
+
+async def heartbeat(worker_id: str):
+    """処理中はリースの有効期限を定期的に延長し続ける"""
+    interval = max(LEASE_SECONDS // 3, 1)
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            async with async_session() as db:
+                await db.execute(
+                    update(models.ItemLease)
+                    .where(models.ItemLease.owner == worker_id)
+                    .values(lease_expires_at=utc_now() + timedelta(seconds=LEASE_SECONDS))
                 )
-                hist_result = await db.execute(hist_stmt)
-                last_record = hist_result.scalar_one_or_none()
-
-                # 3. スクレイピング実行
-                res = await scraper.scrape_site(item.url)
-                
-                if res["status"] == "success":
-                    new_price = res["price"]
-                    current_image = res.get("image_url")
-                    
-                    # DBに画像URLがない場合はついでに更新しておく（既存データ救済用）
-                    if not item.image_url and current_image:
-                        item.image_url = current_image
-                    
-                    # 4. 通知判定（前回の価格が存在し、かつ価格が異なる場合）
-                    if last_record and last_record.price != new_price:
-                        print(f"Price change detected! ¥{last_record.price} -> ¥{new_price}")
-                        send_discord_notification(
-                            item.name, 
-                            last_record.price, 
-                            new_price, 
-                            item.url, 
-                            item.image_url or current_image
-                        )
-                    
-                    # 5. 価格履歴を保存
-                    new_history = models.PriceHistory(
-                        item_id=item.id,
-                        price=new_price
+                await db.commit()
+        except Exception as e:
+            print(f"[{worker_id}] Heartbeat failed: {e}")
+
+async def process_item(worker_id: str, item_id: int) -> bool:
+    """1商品をスクレイピングし、リースを保持している場合のみ結果を保存する。価格履歴を保存できたら True を返す"""
+    item_name = f"item_id={item_id}"
+    try:
+        # 1. 商品と直前の価格履歴を取得（スクレイピング中にトランザクションを開きっぱなしにしない）
+        async with async_session() as db:
+            item = await db.get(models.Item, item_id)
+            if item is None:
+                # 処理待ちの間に削除された商品（リース行もCASCADEで消えている）
+                return False
+
+            hist_stmt = (
+                select(models.PriceHistory)
+                .where(models.PriceHistory.item_id == item.id)
+                .order_by(desc(models.PriceHistory.created_at))
+                .limit(1)
+            )
+            hist_result = await db.execute(hist_stmt)
+            last_record = hist_result.scalar_one_or_none()
+            last_price = last_record.price if last_record else None
+
+        item_name, item_url, item_image_url = item.name, item.url, item.image_url
+        print(f"[{worker_id}] --- Scraping: {item_name} ---")
+
+        # 2. スクレイピング実行（トランザクション外）
+        res = await scraper.scrape_site(item_url)
+
+        # 3. リースを解放しつつ結果を保存（他ワーカーに奪われていたら保存しない）
+        async with async_session() as db:
+            released = await db.execute(finish_lease_stmt(worker_id, item_id))
+            if released.rowcount == 0:
+                print(f"[{worker_id}] Lease lost for {item_name}. Skipping save.")
+                await db.rollback()
+                return False
+
+            notify = False
+            if res["status"] == "success":
+                new_price = res["price"]
+                current_image = res.get("image_url")
+
+                # DBに画像URLがない場合はついでに更新しておく（既存データ救済用）
+                if not item_image_url and current_image:
+                    await db.execute(
+                        update(models.Item)
+                        .where(models.Item.id == item_id)
+                        .values(image_url=current_image)
                     )
-                    db.add(new_history)
-                    print(f"Successfully updated: ¥{new_price}")
+
+                # 4. 価格履歴を保存
+                db.add(models.PriceHistory(item_id=item_id, price=new_price))
+
+                # 通知判定（前回の価格が存在し、かつ価格が異なる場合）
+                notify = last_price is not None and last_price != new_price
+            else:
+                print(f"Scrape failed for {item_name}: {res.get('message')}")
+
+            await db.commit()
+
+        if res["status"] != "success":
+            return False
+        print(f"Successfully updated: ¥{new_price}")
+
+        # 5. 保存が確定してから通知する
+        if notify:
+            print(f"Price change detected! ¥{last_price} -> ¥{new_price}")
+            await asyncio.to_thread(
+                send_discord_notification,
+                item_name,
+                last_price,
+                new_price,
+                item_url,
+                item_image_url or current_image
+            )
+        return True
+
+    except Exception as e:
+        print(f"Error processing {item_name}: {e}")
+        # 失敗した商品も次の周期まで再取得されないよう完了扱いにしてリースを開放する
+        # DB障害が原因の場合はここも失敗しうるので、ワーカー全体を止めないようにする
+        try:
+            async with async_session() as db:
+                await db.execute(finish_lease_stmt(worker_id, item_id))
+                await db.commit()
+        except Exception as release_error:
+            print(f"[{worker_id}] Failed to release lease for {item_name}: {release_error}")
+        return False
+
+async def update_all_prices(worker_id: Optional[str] = None, loop: bool = False):
+    """対象商品をリース単位で確保しながら価格を更新する。複数プロセス・複数ホストで同時実行可能"""
+    worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+    print(f"[{worker_id}] Starting batch update worker...")
+
+    await create_tables()
+    beat = asyncio.create_task(heartbeat(worker_id))
+    processed = 0
+    try:
+        while True:
+            try:
+                # 新しく登録された商品にもリース行を用意する
+                await ensure_leases()
+
+                async with async_session() as db:
+                    cycle_started_at = (await db.execute(select(utc_now()))).scalar_one()
+                if loop:
+                    # 直近 RECHECK_MINUTES 分以内に（他ワーカーも含めて）更新済みの商品は対象外にする
+                    due_before = cycle_started_at - timedelta(minutes=RECHECK_MINUTES)
                 else:
-                    print(f"Scrape failed for {item.name}: {res.get('message')}")
+                    # 1回だけの実行では、実行開始前に更新された商品をすべて対象にする（同じ商品を二度処理しない）
+                    due_before = cycle_started_at
+
+                while True:
+                    item_ids = await claim_items(worker_id, due_before)
+                    if not item_ids:
+                        break
 
+                    print(f"[{worker_id}] Claimed {len(item_ids)} items.")
+                    for item_id in item_ids:
+                        if await process_item(worker_id, item_id):
+                            processed += 1
+                        # サーバーに負荷をかけないよう待機
+                        await asyncio.sleep(SCRAPE_INTERVAL_SECONDS)
             except Exception as e:
-                print(f"Error processing {item.name}: {e}")
-            
-            # サーバーに負荷をかけないよう待機
-            await asyncio.sleep(5) 
-            
-        await db.commit()
-        print("Batch update finished.")
+                if not loop:
+                    raise
+                # 常駐時はDBの一時的な障害などで止まらず、次の周期で再試行する
+                print(f"[{worker_id}] Batch update cycle failed: {e}")
+                # 確保したままのリースはハートビートで延長され続けるため、ここで開放しておく
+                try:
+                    await release_leases(worker_id)
+                except Exception as release_error:
+                    print(f"[{worker_id}] Failed to release leases: {release_error}")
+
+            if not loop:
+                break
+
+            await asyncio.sleep(IDLE_SECONDS)
+    finally:
+        beat.cancel()
+        try:
+            await beat
+        except asyncio.CancelledError:
+            pass
+
+        # 途中で止まった場合も残りのリースを即座に開放する
+        # ここでの失敗で元の例外が隠れないようにする
+        try:
+            await release_leases(worker_id)
+        except Exception as e:
+            print(f"[{worker_id}] Failed to release leases: {e}")
+
+    print(f"[{worker_id}] Batch update finished. {processed} items updated.")
+
+async def main(args):
+    # docker compose stop / scale down は SIGTERM で止めるため、メインタスクをキャンセルして finally でリースを開放する
+    main_task = asyncio.current_task()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, main_task.cancel)
+    try:
+        await update_all_prices(args.worker_id, args.loop)
+    except asyncio.CancelledError:
+        print("Batch update stopped by SIGTERM.")
 
 if __name__ == "__main__":
-    asyncio.run(update_all_prices())
-    
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="全商品の価格を更新する（複数同時実行可）")
+    parser.add_argument("--worker-id", default=None, help="ワーカー識別子（省略時はホスト名+PIDから生成）")
+    parser.add_argument("--loop", action="store_true", help="対象商品がなくなっても終了せず定期的に処理を続ける")
+    args = parser.parse_args()
+    asyncio.run(main(args))
@@ -1,4 +1,5 @@
 import os
+from sqlalchemy import text
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, async_sessionmaker
 from sqlalchemy.orm import DeclarativeBase
 
@@ -15,10 +16,20 @@ async_session = async_sessionmaker(
     class_=AsyncSession
 )
 
+# create_all を複数プロセス（API・価格更新ワーカー）で同時に実行しないための advisory lock のキー
+CREATE_TABLES_LOCK_KEY = 260260
+
 # モデルのベースクラス
 class Base(DeclarativeBase):
     pass
 
+# テーブル作成（呼び出し側で models を import してから使う）
+# 同時に起動しても CREATE TABLE が競合しないよう advisory lock で直列化する
+async def create_tables():
+    async with engine.begin() as conn:
+        await conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": CREATE_TABLES_LOCK_KEY})
+        await conn.run_sync(Base.metadata.create_all)
+
 # FastAPIで使うための依存性注入関数
 async def get_db():
     async with async_session() as session:
@@ -28,8 +28,7 @@ app.add_middleware(
 # 起動時のテーブル作成
 @app.on_event("startup")
 async def startup():
-    async with database.engine.begin() as conn:
-        await conn.run_sync(models.Base.metadata.create_all)
+    await database.create_tables()
 
 # APIキー認証
 def verify_api_key(x_api_key: str = Header(None)):
@@ -45,4 +45,18 @@ class SearchQuery(Base):
     last_seen_ids = Column(JSON, default=list) 
     
     created_at = Column(DateTime, default=datetime.utcnow)
-    
\ No newline at end of file
+    
+class ItemLease(Base):
+    """batch_update の複数ワーカー間で商品を排他的に割り当てるためのリース"""
+    __tablename__ = "item_leases"
+
+    item_id = Column(Integer, ForeignKey("items.id", ondelete="CASCADE"), primary_key=True)
+
+    # 現在この商品を担当しているワーカーID（未割り当てなら NULL）
+    owner = Column(String, nullable=True, index=True)
+
+    # リースの有効期限。ワーカーが落ちてもこの時刻を過ぎれば他のワーカーが再取得できる
+    lease_expires_at = Column(DateTime, nullable=True)
+
+    # 最後にスクレイピングが完了した時刻（次回の対象判定に使う）
+    last_checked_at = Column(DateTime, nullable=True, index=True)